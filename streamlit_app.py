@@ -2,14 +2,93 @@ import streamlit as st
 import json
 import re
 import sqlparse
+import sqlglot
+from sqlglot import exp
 from google.generativeai import GenerativeModel
 import google.generativeai as genai
 from dotenv import load_dotenv
 import os
+import pickle
+from pathlib import Path
+import orjson
+import ahocorasick
+import numpy as np
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # Load environment variables
 load_dotenv()
 
+# Shared worker pool for validation work that overlaps with network calls
+_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# Precompiled patterns used on every query
+# Maps ASCII punctuation (anything not a word or space character) to a space; non-ASCII
+# text falls back to the regex so symbols such as fullwidth '，' and '？' are stripped too
+_PUNCT_TABLE = {
+    c: ' ' for c in range(128)
+    if not (chr(c).isalnum() or chr(c).isspace() or chr(c) == '_')
+}
+_PUNCT_RE = re.compile(r'[^\w\s]')
+_CODE_FENCE_RE = re.compile(r'^```sql\s*|\s*```$', re.IGNORECASE)
+_WORD_RE = re.compile(r'\w+')
+
+# Top-level sqlglot nodes that only read data (plain SELECTs, set operations, parenthesised queries)
+_READ_ONLY_QUERY_TYPES = (exp.Select, exp.Union, exp.Intersect, exp.Except, exp.Subquery)
+
+# Keyword groups matched in a single Aho-Corasick pass
+_DML_KEYWORDS = ['delete', 'remove', 'erase', 'clear', 'insert', 'add', 'create', 'created',
+                 'update', 'modify', 'change', 'edit', 'updated', 'drop', 'truncate', 'alter']
+_UNAVAILABLE_KEYWORDS = ['removed', 'deleted', 'archived', 'inactive', 'disabled', 'removal', 'deletion', 'archive']
+
+# Foreign key relationships as (child_table, child_column, parent_table, parent_column)
+_FOREIGN_KEYS = [
+    ('incidents', 'user_id', 'users', 'user_id'),
+    ('assets', 'assigned_to', 'users', 'user_id'),
+    ('tickets', 'user_id', 'users', 'user_id'),
+    ('tickets', 'assigned_to', 'users', 'user_id'),
+    ('departments', 'manager_id', 'users', 'user_id'),
+    ('knowledge_base', 'created_by', 'users', 'user_id'),
+    ('change_requests', 'requested_by', 'users', 'user_id'),
+    ('logs', 'user_id', 'users', 'user_id'),
+]
+
+# Batched Gemini requests
+_BATCH_WINDOW_SECONDS = 0.05
+_BATCH_MAX_SIZE = 8
+_BATCH_ANSWER_RE = re.compile(r'^\s*#{2,}\s*Answer\s+(\d+)\s*$', re.MULTILINE)
+
+# Semantic response cache settings
+_EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+_SEMANTIC_CACHE_THRESHOLD = 0.92
+_SEMANTIC_CACHE_MAX_ENTRIES = 1024
+_SEMANTIC_BLOCK_ROWS = 512
+_EXACT_CACHE_MAX_ENTRIES = 1024
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+
+# Learned NL -> SQL templates
+_TEMPLATES_PATH = Path(__file__).resolve().with_name('sql_templates.json')
+_SQL_LITERAL_RE = re.compile(r"'((?:[^']|'')*)'|\b(\d+(?:\.\d+)?)\b")
+_NUMBER_SLOT_PATTERN = r"\d+(?:\.\d+)?"
+_TEMPLATE_MIN_EXAMPLES = 2
+
+def _strip_punctuation(text):
+    """Replace every non-word, non-space character with a space"""
+    if text.isascii():
+        return text.translate(_PUNCT_TABLE)
+    return _PUNCT_RE.sub(' ', text)
+
+def _write_atomic(path, data):
+    """Write bytes to a temp file beside path and swap it in, so readers never see a partial file"""
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
 class Text2SQLSystem:
     def __init__(self):
         self.schema = self.load_schema()
@@ -26,148 +105,445 @@ class Text2SQLSystem:
             'change': 'change_requests',
             'log': 'logs'
         }
+        # Longest keys first so multi-word synonyms like 'department head' win
+        self._synonym_re = re.compile(r'\b(' + '|'.join(map(re.escape, sorted(self.synonyms, key=len, reverse=True))) + r')\b')
         self.unsafe_keywords = ['DELETE', 'DROP', 'TRUNCATE', 'ALTER', 'CREATE', 'INSERT', 'UPDATE']
+        self._unsafe_set = frozenset(self.unsafe_keywords)
+        self._kw_automaton = self._build_keyword_automaton()
         
+        # Configure Gemini once so the client and its connection are reused across queries
+        self._model = self.load_model()
+        
+        # Optional second Gemini pass that reviews generated SQL alongside validation
+        self._critic_enabled = self._model is not None and os.getenv('TEXT2SQL_SQL_CRITIC', '').lower() in ('1', 'true', 'yes')
+        
+        # The schema never changes at runtime, so build the prompt context and lookup tables once
+        tables = self.schema['tables'] if self.schema else []
+        self._table_context = {t['table_name']: self._build_table_context(t) for t in tables}
+        self._schema_context = self._build_schema_context() if self.schema else None
+        self.sidebar_markdown = [(t['table_name'], self._build_sidebar_markdown(t)) for t in tables]
+        self._tables_by_column = {}
+        for t in tables:
+            for col_name in t['columns']:
+                self._tables_by_column.setdefault(col_name, set()).add(t['table_name'])
+        self._fk_targets = {}
+        self._fk_sources = {}
+        for child_table, _, parent_table, _ in _FOREIGN_KEYS:
+            self._fk_targets.setdefault(child_table, set()).add(parent_table)
+            self._fk_sources.setdefault(parent_table, set()).add(child_table)
+        # Table names and their singular forms ("department", "change_request")
+        self._table_aliases = {}
+        for table_name in self._table_context:
+            self._table_aliases[table_name] = table_name
+            if table_name.endswith('s'):
+                self._table_aliases[table_name[:-1]] = table_name
+        self._tables_by_name = {t['table_name']: t for t in tables}
+        self._cols_by_table = {name: frozenset(t['columns']) for name, t in self._tables_by_name.items()}
+        self._valid_tables = frozenset(self._tables_by_name)
+        
+        # Response caches: exact match on the processed query, then embedding similarity.
+        # One system is shared by every session (see get_system), so access is locked.
+        self._cache_lock = threading.Lock()
+        self._exact_cache = OrderedDict()  # LRU order, oldest first
+        self._semantic_entries = []  # (query, SQL) for rows [0, len) of the arrays below
+        self._cache_q8 = None  # int8 embeddings, one row per entry
+        self._cache_scale = None  # float32 per-row dequantization scales
+        self._cache_last_used = None  # LRU clock value per row
+        self._semantic_clock = 0
+        self._embedder = None
+        self._embedder_failed = False
+        self._embedder_lock = threading.Lock()
+        
+        # Per-thread handle to the prompt queue of the process_batch call being served, if any
+        self._batch_local = threading.local()
+        
+        # Learned query templates, clustered from validated examples, that bypass Gemini entirely
+        self._templates = self.load_templates()
+        self._templates_lock = threading.Lock()
+        
+    def load_model(self):
+        """Configure the Gemini API and create the model - use environment variables only"""
+        api_key = os.getenv('GEMINI_API_KEY') or os.getenv('GEMINI_API_KEY_2')
+        if not api_key:
+            return None
+        
+        genai.configure(api_key=api_key)
+        return GenerativeModel('gemini-1.5-flash')
+    
+    def warm_up(self):
+        """Open the Gemini connection and load the embedding model before the first query"""
+        if self._model is not None:
+            try:
+                self._model.generate_content('warmup', generation_config={'max_output_tokens': 1})
+            except Exception as e:
+                print(f"DEBUG - Gemini warm-up failed: {e}")
+        self._get_embedder()
+    
     def load_schema(self):
-        """Load the database schema from JSON file"""
+        """Load the database schema from JSON file, reusing a pickled copy when it is up to date"""
         try:
-            # Try multiple possible paths for the schema file
+            # Try the working directory first, then the directory containing this app
             schema_paths = [
-                'simple_enterprise_schema.json',
-                './simple_enterprise_schema.json',
-                '/Users/adityarajput/Assignment 1 /simple_enterprise_schema.json'
+                Path('simple_enterprise_schema.json'),
+                Path(__file__).resolve().with_name('simple_enterprise_schema.json')
             ]
             
             for path in schema_paths:
                 try:
-                    with open(path, 'r') as f:
-                        return json.load(f)
+                    source_mtime = path.stat().st_mtime
                 except FileNotFoundError:
                     continue
+                
+                cache_path = path.with_name(path.name + '.pkl')
+                try:
+                    if cache_path.stat().st_mtime >= source_mtime:
+                        return pickle.loads(cache_path.read_bytes())
+                except Exception:
+                    # Missing, stale-format or truncated cache: fall back to the JSON
+                    pass
+                
+                schema = orjson.loads(path.read_bytes())
+                try:
+                    _write_atomic(cache_path, pickle.dumps(schema, protocol=pickle.HIGHEST_PROTOCOL))
+                except OSError as e:
+                    print(f"DEBUG - Could not write schema cache: {e}")
+                return schema
             
-            st.error(f"Schema file not found! Tried paths: {schema_paths}")
+            st.error(f"Schema file not found! Tried paths: {[str(path) for path in schema_paths]}")
             return None
         except Exception as e:
             st.error(f"Error loading schema: {str(e)}")
             return None
     
+    def _build_keyword_automaton(self):
+        """Build one automaton that tags every DML and unavailable-info keyword"""
+        categories = {}
+        for category, keywords in (('dml', _DML_KEYWORDS), ('unavailable', _UNAVAILABLE_KEYWORDS)):
+            for keyword in keywords:
+                categories.setdefault(keyword, set()).add(category)
+        
+        automaton = ahocorasick.Automaton()
+        for keyword, keyword_categories in categories.items():
+            automaton.add_word(keyword, (frozenset(keyword_categories), keyword))
+        automaton.make_automaton()
+        return automaton
+    
+    def scan_keywords(self, text, stop_on=None):
+        """Return whole-word keyword hits in a lowercase text, bucketed by category.
+        
+        If stop_on names a category, scanning ends at the first hit in that category.
+        """
+        hits = {'dml': [], 'unavailable': []}
+        text_length = len(text)
+        for end, (keyword_categories, keyword) in self._kw_automaton.iter(text):
+            # The automaton matches substrings; keep only whole-word occurrences
+            start = end - len(keyword) + 1
+            if start > 0 and (text[start - 1].isalnum() or text[start - 1] == '_'):
+                continue
+            if end + 1 < text_length and (text[end + 1].isalnum() or text[end + 1] == '_'):
+                continue
+            for category in keyword_categories:
+                hits[category].append(keyword)
+            if stop_on in keyword_categories:
+                break
+        return hits
+    
     def preprocess_query(self, query):
         """Clean and preprocess the user query"""
         # Clean the query
         cleaned_query = query.lower().strip()
-        cleaned_query = re.sub(r'[^\w\s]', ' ', cleaned_query)
+        cleaned_query = _strip_punctuation(cleaned_query)
         cleaned_query = ' '.join(cleaned_query.split())
         
-        # Check for potential DML intent (but don't block - let Gemini decide)
-        potential_dml_patterns = [
-            r'\b(delete|remove|erase|clear)\b',
-            r'\b(insert|add|create|created)\b',
-            r'\b(update|modify|change|edit|updated)\b',
-            r'\b(drop|truncate|alter)\b'
-        ]
-        
-        possible_dml = False
-        detected_words = []
-        for pattern in potential_dml_patterns:
-            match = re.search(pattern, cleaned_query)
-            if match:
-                possible_dml = True
-                # Extract the matched word for context
-                detected_words.append(match.group(1))  # Get the first captured group
+        # The scan stops at the first unavailable-info keyword, so unsupported queries
+        # are rejected before any DML bookkeeping or synonym replacement
+        keyword_hits = self.scan_keywords(cleaned_query, stop_on='unavailable')
         
         # Check for queries asking for information not available in schema
-        unavailable_info_patterns = [
-            r'\b(removed|deleted|archived|inactive|disabled)\b',
-            r'\b(how many.*removed|count.*removed|list.*removed)\b',
-            r'\b(removal|deletion|archive)\b'
-        ]
+        if keyword_hits['unavailable']:
+            return None, f"Unsupported Query: The query asks for information about user removal/deletion, but the schema does not contain columns for tracking removed users (like 'removed', 'deleted', or 'archived' status)."
         
-        for pattern in unavailable_info_patterns:
-            if re.search(pattern, cleaned_query):
-                return None, f"Unsupported Query: The query asks for information about user removal/deletion, but the schema does not contain columns for tracking removed users (like 'removed', 'deleted', or 'archived' status)."
+        # Check for potential DML intent (but don't block - let Gemini decide)
+        detected_words = list(dict.fromkeys(keyword_hits['dml']))
+        possible_dml = bool(detected_words)
         
         # Replace synonyms
-        words = cleaned_query.split()
-        processed_words = []
-        for word in words:
-            if word in self.synonyms:
-                processed_words.append(self.synonyms[word])
-            else:
-                processed_words.append(word)
+        processed_query = self._synonym_re.sub(lambda m: self.synonyms[m.group(1)], cleaned_query)
         
-        processed_query = ' '.join(processed_words)
+        # Record which tables the query touches so the prompt can include only those
+        relevant_tables = self.find_relevant_tables(processed_query)
         
         # DEBUG: Print preprocessing results
         print(f"DEBUG - Processed query: {processed_query}")
         print(f"DEBUG - Possible DML: {possible_dml}")
         print(f"DEBUG - Detected words: {detected_words}")
+        print(f"DEBUG - Relevant tables: {sorted(relevant_tables)}")
         
         # Return both the processed query and DML detection info
         return {
             'query': processed_query,
             'possible_dml': possible_dml,
-            'detected_words': detected_words
+            'detected_words': detected_words,
+            'relevant_tables': relevant_tables
         }
     
     def check_unsafe_query(self, query):
         """Check if query contains unsafe operations"""
-        query_upper = query.upper()
-        for keyword in self.unsafe_keywords:
-            # Use word boundaries to avoid false positives in column names
-            pattern = r'\b' + keyword + r'\b'
-            if re.search(pattern, query_upper):
-                return False, f"DML operations like {keyword} are not supported. Only SELECT queries are allowed."
+        # Whole-word tokens (underscores included) avoid false positives in column names
+        keyword = next((m.group(0) for m in _WORD_RE.finditer(query.upper()) if m.group(0) in self._unsafe_set), None)
+        if keyword:
+            return False, f"DML operations like {keyword} are not supported. Only SELECT queries are allowed."
         return True, "Safe query"
     
-    def create_schema_context(self):
-        """Create schema context for the LLM"""
-        context = "Database Schema:\n\n"
-        for table in self.schema['tables']:
-            context += f"Table: {table['table_name']}\n"
-            context += f"Description: {table['description']}\n"
-            context += "Columns:\n"
-            for col_name, col_desc in table['columns'].items():
-                context += f"  - {col_name}: {col_desc}\n"
-            context += "\n"
-        
-        context += "\nImportant Notes:\n"
-        context += "- Use only the tables and columns listed above\n"
-        context += "- For joins, use the correct foreign key relationships:\n"
-        context += "  * incidents.user_id -> users.user_id\n"
-        context += "  * assets.assigned_to -> users.user_id\n"
-        context += "  * tickets.user_id -> users.user_id\n"
-        context += "  * tickets.assigned_to -> users.user_id\n"
-        context += "  * departments.manager_id -> users.user_id\n"
-        context += "  * knowledge_base.created_by -> users.user_id\n"
-        context += "  * change_requests.requested_by -> users.user_id\n"
-        context += "  * logs.user_id -> users.user_id\n"
-        context += "- Only generate SELECT queries, no DML operations\n"
-        
-        return context
-    
-    def generate_sql_with_gemini(self, processed_data):
-        """Use Gemini API to generate SQL from natural language"""
+    def _build_table_context(self, table):
+        """Create the schema context block for a single table"""
+        parts = [f"Table: {table['table_name']}", f"Description: {table['description']}", "Columns:"]
+        parts.extend(f"  - {col_name}: {col_desc}" for col_name, col_desc in table['columns'].items())
+        parts.append("")
+        return '\n'.join(parts)
+    
+    def _build_sidebar_markdown(self, table):
+        """Create the markdown shown in the schema sidebar for a single table"""
+        lines = [f"**Description:** {table['description']}", "**Columns:**"]
+        lines.extend(f"• {col_name}: {col_desc}" for col_name, col_desc in table['columns'].items())
+        return '\n\n'.join(lines)
+    
+    def _build_schema_context(self, table_names=None):
+        """Create schema context for the LLM, optionally limited to the given tables"""
+        if table_names is None:
+            table_names = self._table_context.keys()
+        
+        parts = ["Database Schema:\n"]
+        parts.extend(self._table_context[name] for name in self._table_context if name in table_names)
+        parts.append("")
+        parts.append("Important Notes:")
+        parts.append("- Use only the tables and columns listed above")
+        parts.append("- For joins, use the correct foreign key relationships:")
+        parts.extend(
+            f"  * {child_table}.{child_col} -> {parent_table}.{parent_col}"
+            for child_table, child_col, parent_table, parent_col in _FOREIGN_KEYS
+            if child_table in table_names and parent_table in table_names
+        )
+        parts.append("- Only generate SELECT queries, no DML operations\n")
+        
+        return '\n'.join(parts)
+    
+    def find_relevant_tables(self, processed_query):
+        """Return the schema tables a processed query refers to, plus the tables they join to.
+        
+        An empty set (no table named in the query) means the full schema should be used.
+        """
+        words = processed_query.split()
+        relevant = {self._table_aliases[word] for word in words if word in self._table_aliases}
+        if not relevant:
+            # Column words alone ("name", "status") are too ambiguous to narrow the schema
+            return relevant
+        
+        for word in words:
+            relevant.update(self._tables_by_column.get(word, ()))
+        
+        # Follow foreign keys both ways: parents being joined to and children referencing them
+        for table_name in list(relevant):
+            relevant.update(self._fk_targets.get(table_name, ()))
+            relevant.update(self._fk_sources.get(table_name, ()))
+        return relevant
+    
+    def _get_embedder(self):
+        """Lazily load the sentence embedding model used by the semantic cache.
+        
+        Returns None while another thread is loading the model, so queries skip the
+        semantic tier instead of waiting on the download.
+        """
+        if self._embedder is not None or self._embedder_failed:
+            return self._embedder
+        if not self._embedder_lock.acquire(blocking=False):
+            return None
         try:
-            # Configure Gemini API - use environment variables only
-            api_key = os.getenv('GEMINI_API_KEY') or os.getenv('GEMINI_API_KEY_2')
-            if not api_key:
-                return None, "Gemini API key not found. Please set GEMINI_API_KEY or GEMINI_API_KEY_2 environment variable."
+            if self._embedder is None and not self._embedder_failed:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                    self._embedder = SentenceTransformer(_EMBEDDING_MODEL_NAME)
+                except Exception as e:
+                    # Semantic caching is an optimisation only; keep working without it
+                    print(f"DEBUG - Semantic cache disabled: {e}")
+                    self._embedder_failed = True
+            return self._embedder
+        finally:
+            self._embedder_lock.release()
+    
+    def _embed(self, processed_query):
+        """Return the normalised embedding for a processed query, or None if unavailable"""
+        embedder = self._get_embedder()
+        if embedder is None:
+            return None
+        return embedder.encode(processed_query, normalize_embeddings=True).astype(np.float32)
+    
+    def _quantize(self, embedding):
+        """Quantize an embedding to int8 with a per-vector scale"""
+        scale = max(float(np.abs(embedding).max()) / 127, np.finfo(np.float32).tiny)
+        return np.round(embedding / scale).astype(np.int8), np.float32(scale)
+    
+    def _semantic_lookup(self, embedding):
+        """Return the (query, SQL) entry most similar to the embedding, if above the threshold"""
+        if embedding is None:
+            return None, None
+        
+        with self._cache_lock:
+            count = len(self._semantic_entries)
+            if count == 0:
+                return None, None
             
-            genai.configure(api_key=api_key)
-            model = GenerativeModel('gemini-1.5-flash')
+            # Score in float32 one block of rows at a time so only a block-sized dequantized
+            # copy exists; embeddings are normalised, so the dot product is cosine similarity
+            similarities = np.empty(count, dtype=np.float32)
+            for start in range(0, count, _SEMANTIC_BLOCK_ROWS):
+                stop = min(start + _SEMANTIC_BLOCK_ROWS, count)
+                block = self._cache_q8[start:stop].astype(np.float32)
+                similarities[start:stop] = (block @ embedding) * self._cache_scale[start:stop]
+            best = int(np.argmax(similarities))
+            if similarities[best] < _SEMANTIC_CACHE_THRESHOLD:
+                return None, None
             
-            # Extract data from processed_data
-            processed_query = processed_data['query']
-            possible_dml = processed_data['possible_dml']
-            detected_words = processed_data.get('detected_words', [])
+            self._semantic_clock += 1
+            self._cache_last_used[best] = self._semantic_clock
+            print(f"DEBUG - Semantic cache hit ({similarities[best]:.3f}): {self._semantic_entries[best][0]}")
+            return self._semantic_entries[best]
+    
+    def _semantic_store(self, embedding, processed_query, sql_query):
+        """Add a query/SQL pair to the semantic cache, replacing the least recently used entry when full"""
+        if embedding is None:
+            return
+        q8, scale = self._quantize(embedding)
+        with self._cache_lock:
+            if any(cached_query == processed_query for cached_query, _ in self._semantic_entries):
+                return
+            if self._cache_q8 is None:
+                # Preallocate so inserts write one row instead of copying the whole matrix
+                self._cache_q8 = np.zeros((_SEMANTIC_CACHE_MAX_ENTRIES, q8.shape[0]), dtype=np.int8)
+                self._cache_scale = np.zeros(_SEMANTIC_CACHE_MAX_ENTRIES, dtype=np.float32)
+                self._cache_last_used = np.zeros(_SEMANTIC_CACHE_MAX_ENTRIES, dtype=np.int64)
             
-            # Create the prompt
-            schema_context = self.create_schema_context()
+            count = len(self._semantic_entries)
+            if count < _SEMANTIC_CACHE_MAX_ENTRIES:
+                row = count
+                self._semantic_entries.append((processed_query, sql_query))
+            else:
+                row = int(np.argmin(self._cache_last_used))
+                self._semantic_entries[row] = (processed_query, sql_query)
             
-            # Add DML detection context if needed
-            dml_context = ""
-            if possible_dml:
-                dml_context = f"""
+            self._semantic_clock += 1
+            self._cache_q8[row] = q8
+            self._cache_scale[row] = scale
+            self._cache_last_used[row] = self._semantic_clock
+    
+    def _semantic_evict(self, processed_query):
+        """Remove a stale entry from the semantic cache"""
+        with self._cache_lock:
+            index = next((i for i, (cached_query, _) in enumerate(self._semantic_entries) if cached_query == processed_query), None)
+            if index is None:
+                return  # Already evicted by another session
+            # Move the last row into the freed slot to keep rows [0, count) filled
+            last = len(self._semantic_entries) - 1
+            self._semantic_entries[index] = self._semantic_entries[last]
+            self._cache_q8[index] = self._cache_q8[last]
+            self._cache_scale[index] = self._cache_scale[last]
+            self._cache_last_used[index] = self._cache_last_used[last]
+            self._semantic_entries.pop()
+    
+    def _literals_match(self, processed_query, cached_query, sql_query):
+        """Check that SQL cached for a similar query carries no values specific to that query"""
+        literals = [
+            literal.group(2) if literal.group(1) is None else literal.group(1).replace("''", "'")
+            for literal in _SQL_LITERAL_RE.finditer(sql_query)
+        ]
+        if not literals:
+            return True
+        
+        # "top 5 users" and "top 10 users" embed almost identically but need different SQL
+        if set(_NUMBER_RE.findall(processed_query)) != set(_NUMBER_RE.findall(cached_query)):
+            return False
+        
+        # Every value in the cached SQL must also be mentioned in the new query
+        for value in literals:
+            normalized_value = ' '.join(_strip_punctuation(value.lower()).split())
+            if normalized_value and not re.search(r'\b' + re.escape(normalized_value) + r'\b', processed_query):
+                return False
+        return True
+    
+    def _exact_cache_get(self, processed_query):
+        """Return the exact-cache entry for a query, marking it as recently used"""
+        with self._cache_lock:
+            cached = self._exact_cache.get(processed_query)
+            if cached is not None:
+                self._exact_cache.move_to_end(processed_query)
+            return cached
+    
+    def _exact_cache_put(self, processed_query, result):
+        """Store an exact-cache entry, dropping the least recently used one when full"""
+        with self._cache_lock:
+            self._exact_cache[processed_query] = result
+            self._exact_cache.move_to_end(processed_query)
+            if len(self._exact_cache) > _EXACT_CACHE_MAX_ENTRIES:
+                self._exact_cache.popitem(last=False)
+    
+    def generate_sql_with_gemini(self, processed_data, on_chunk=None):
+        """Generate SQL for a processed query, serving repeated and paraphrased queries from cache.
+        
+        Sets processed_data['cache_hit'] when the SQL came from a cache and has already been
+        validated; fresh SQL is only cached later through cache_sql, once it passes validation.
+        """
+        processed_query = processed_data['query']
+        processed_data['cache_hit'] = True
+        
+        # Tier 1: exact match on the normalised query
+        cached = self._exact_cache_get(processed_query)
+        if cached is not None:
+            sql_query, error = cached
+            # Re-validate cached SQL in case the schema changed since it was stored
+            if sql_query is None or self.validate_sql(sql_query)[0]:
+                print(f"DEBUG - Exact cache hit: {processed_query}")
+                return cached
+            with self._cache_lock:
+                self._exact_cache.pop(processed_query, None)
+        
+        # Tier 2: semantic match against previously answered queries. Possible DML
+        # queries are left to Gemini since a paraphrase may flip the intent.
+        embedding = None if processed_data['possible_dml'] else self._embed(processed_query)
+        processed_data['embedding'] = embedding
+        cached_query, sql_query = self._semantic_lookup(embedding)
+        if sql_query is not None and not self._literals_match(processed_query, cached_query, sql_query):
+            print(f"DEBUG - Semantic cache hit rejected, values differ from: {cached_query}")
+        elif sql_query is not None:
+            if self.validate_sql(sql_query)[0]:
+                self._exact_cache_put(processed_query, (sql_query, None))
+                return sql_query, None
+            self._semantic_evict(cached_query)
+        
+        processed_data['cache_hit'] = False
+        sql_query, error = self._request_sql_from_gemini(processed_data, on_chunk)
+        
+        # Cache refusals from the model, not configuration or transport failures.
+        # Refusals are only returned after a full-schema attempt, so they are safe to cache.
+        if error and error.startswith("Unsupported Query"):
+            self._exact_cache_put(processed_query, (None, error))
+        
+        return sql_query, error
+    
+    def cache_sql(self, processed_data, sql_query):
+        """Cache freshly generated SQL once it has passed validation"""
+        self._exact_cache_put(processed_data['query'], (sql_query, None))
+        self._semantic_store(processed_data.get('embedding'), processed_data['query'], sql_query)
+    
+    def _build_prompt(self, processed_data, schema_context):
+        """Create the SQL generation prompt for a processed query"""
+        processed_query = processed_data['query']
+        possible_dml = processed_data['possible_dml']
+        detected_words = processed_data.get('detected_words', [])
+        
+        # Add DML detection context if needed
+        dml_context = ""
+        if possible_dml:
+            dml_context = f"""
 IMPORTANT DML DETECTION:
 This query contains words like: {', '.join(detected_words)}
 Please carefully analyze if these words refer to:
@@ -177,8 +553,8 @@ Please carefully analyze if these words refer to:
 If the query is asking for information about data (SELECT), generate SQL.
 If the query is trying to modify data (DML), respond with: "ERROR: Only SELECT queries are allowed."
 """
-            
-            prompt = f"""{schema_context}{dml_context}
+        
+        prompt = f"""{schema_context}{dml_context}
 
 Convert this natural language query to SQL:
 "{processed_query}"
@@ -206,100 +582,158 @@ EXAMPLE:
 
 IMPORTANT: If the query cannot be answered with the available schema (missing tables/columns), respond with: "ERROR: Query cannot be answered with available schema"
 """
+        return prompt
+    
+    def _generate_text(self, prompt, on_chunk=None):
+        """Send a prompt to Gemini and return the cleaned response text"""
+        # DEBUG: Print the full prompt being sent to Gemini
+        print(f"DEBUG - Full prompt sent to Gemini:\n{prompt}")
+        
+        batch_queue = getattr(self._batch_local, 'queue', None)
+        if batch_queue is not None:
+            # Queries from the same process_batch call share batched requests
+            sql_query = self._submit_prompt(batch_queue, prompt).result()
+        elif on_chunk is None:
+            sql_query = self._model.generate_content(prompt).text
+        else:
+            response = self._model.generate_content(prompt, stream=True)
+            sql_query = ""
+            refusing = False
+            for chunk in response:
+                sql_query += chunk.text
+                # Stop showing partial text once Gemini starts refusing, but read the whole
+                # refusal so the full message is returned (and cached)
+                if not refusing:
+                    head = sql_query.lstrip()[:6].upper()
+                    refusing = head == 'ERROR:'
+                    # Hold back text that could still turn into a refusal
+                    if not refusing and not 'ERROR:'.startswith(head):
+                        on_chunk(sql_query)
+        sql_query = sql_query.strip()
+        
+        # DEBUG: Print Gemini's raw response
+        print(f"DEBUG - Gemini raw response: {repr(sql_query)}")
+        
+        # Clean up the response (remove markdown formatting if present)
+        if sql_query.startswith('```'):
+            sql_query = _CODE_FENCE_RE.sub('', sql_query)
+        
+        # DEBUG: Print cleaned response
+        print(f"DEBUG - Cleaned response: {repr(sql_query)}")
+        return sql_query
+    
+    def _request_sql_from_gemini(self, processed_data, on_chunk=None):
+        """Use Gemini API to generate SQL from natural language, streaming partial text to on_chunk"""
+        try:
+            if self._model is None:
+                return None, "Gemini API key not found. Please set GEMINI_API_KEY or GEMINI_API_KEY_2 environment variable."
             
-            # DEBUG: Print the full prompt being sent to Gemini
-            print(f"DEBUG - Full prompt sent to Gemini:\n{prompt}")
-            
-            response = model.generate_content(prompt)
-            sql_query = response.text.strip()
-            
-            # DEBUG: Print Gemini's raw response
-            print(f"DEBUG - Gemini raw response: {repr(sql_query)}")
-            
-            # Clean up the response (remove markdown formatting if present)
-            if sql_query.startswith('```'):
-                sql_query = re.sub(r'^```sql\s*|\s*```$', '', sql_query, flags=re.IGNORECASE)
-            
-            # DEBUG: Print cleaned response
-            print(f"DEBUG - Cleaned response: {repr(sql_query)}")
-            
-            # Check if Gemini returned an error instead of SQL
-            if sql_query.upper().startswith('ERROR:') or 'cannot be answered' in sql_query.lower():
-                print(f"DEBUG - Gemini returned error: {sql_query}")
-                return None, f"Unsupported Query: {sql_query}"
+            # Try a prompt with only the relevant tables first; a schema refusal from that reduced
+            # prompt may just mean a needed table was left out, so retry with the full schema
+            schema_contexts = []
+            relevant_tables = processed_data.get('relevant_tables')
+            if relevant_tables and len(relevant_tables) < len(self._table_context):
+                schema_contexts.append(self._build_schema_context(relevant_tables))
+            schema_contexts.append(self._schema_context)
             
-            print(f"DEBUG - Returning SQL query: {sql_query}")
-            return sql_query, None
+            for schema_context in schema_contexts:
+                sql_query = self._generate_text(self._build_prompt(processed_data, schema_context), on_chunk)
+                
+                # Check if Gemini returned an error instead of SQL
+                if sql_query.upper().startswith('ERROR:') or 'cannot be answered' in sql_query.lower():
+                    print(f"DEBUG - Gemini returned error: {sql_query}")
+                    # Other refusals (e.g. DML requests) would be refused again with the full schema
+                    if schema_context is not self._schema_context and 'cannot be answered' in sql_query.lower():
+                        print("DEBUG - Retrying with the full schema")
+                        continue
+                    return None, f"Unsupported Query: {sql_query}"
+                
+                print(f"DEBUG - Returning SQL query: {sql_query}")
+                return sql_query, None
             
         except Exception as e:
             return None, f"Error generating SQL: {str(e)}"
     
+    def extract_references_sqlglot(self, sql_query):
+        """Extract statement type, tables and qualified columns using the sqlglot AST"""
+        tree = sqlglot.parse_one(sql_query, read='sqlite')
+        if tree is None:
+            return None
+        
+        # CTE names are referenced like tables but are not part of the schema
+        cte_names = {cte.alias.lower() for cte in tree.find_all(exp.CTE)}
+        tables_in_query = {t.name.lower() for t in tree.find_all(exp.Table)} - cte_names
+        columns_in_query = {(c.table.lower(), c.name.lower()) for c in tree.find_all(exp.Column) if c.table}
+        return isinstance(tree, _READ_ONLY_QUERY_TYPES), tables_in_query, columns_in_query
+    
+    def extract_references_sqlparse(self, sql_query):
+        """Extract statement type, tables and qualified columns by walking sqlparse tokens"""
+        parsed = sqlparse.parse(sql_query)
+        if not parsed:
+            return None
+        
+        statement = parsed[0]
+        tables_in_query = set()
+        columns_in_query = set()
+        tokens = statement.flatten()
+        previous_keyword = None  # Upper-cased keyword directly before the current name, if any
+        
+        for token in tokens:
+            if token.ttype is sqlparse.tokens.Name:
+                value = token.value
+                lower_value = value.lower()
+                if previous_keyword in ('FROM', 'JOIN'):
+                    tables_in_query.add(lower_value)
+                # Check for column references anywhere in the query (SELECT list, WHERE clauses, ...)
+                if '.' in value:
+                    table_name, _, col_name = lower_value.partition('.')
+                    columns_in_query.add((table_name, col_name))
+                previous_keyword = None
+            elif token.ttype is sqlparse.tokens.Keyword:
+                previous_keyword = token.value.upper()
+        
+        return statement.get_type() == 'SELECT', tables_in_query, columns_in_query
+    
     def validate_sql(self, sql_query):
         """Validate the generated SQL query"""
         try:
-            # Parse SQL to check syntax
-            parsed = sqlparse.parse(sql_query)
-            if not parsed:
+            # Extract table names and column references from the query
+            try:
+                references = self.extract_references_sqlglot(sql_query)
+            except Exception as e:
+                print(f"DEBUG - sqlglot parse failed, falling back to sqlparse: {e}")
+                references = self.extract_references_sqlparse(sql_query)
+            
+            if references is None:
                 return False, "Unsupported Query: Invalid SQL syntax"
             
-            statement = parsed[0]
+            is_select, tables_in_query, columns_in_query = references
             
             # Check if it's a SELECT statement
-            if not statement.get_type() == 'SELECT':
+            if not is_select:
                 return False, "Unsupported Query: Only SELECT queries are supported. DML operations (INSERT, UPDATE, DELETE) are not allowed."
             
-            # Extract table names and column references from the query
-            tables_in_query = set()
-            columns_in_query = set()
-            tokens = statement.flatten()
-            current_token = None
-            
-            for token in tokens:
-                if token.ttype is sqlparse.tokens.Name:
-                    if current_token and current_token.value.upper() in ['FROM', 'JOIN']:
-                        tables_in_query.add(token.value.lower())
-                    elif current_token and current_token.value.upper() == 'SELECT':
-                        # This might be a column reference
-                        if '.' in token.value:
-                            table_name, col_name = token.value.lower().split('.', 1)
-                            columns_in_query.add((table_name, col_name))
-                    # Check for column references anywhere in the query (including WHERE clauses)
-                    if '.' in token.value:
-                        table_name, col_name = token.value.lower().split('.', 1)
-                        columns_in_query.add((table_name, col_name))
-                    current_token = token
-                elif token.ttype is sqlparse.tokens.Keyword:
-                    current_token = token
-            
             # Validate table names
-            valid_tables = {table['table_name'] for table in self.schema['tables']}
-            invalid_tables = tables_in_query - valid_tables
+            invalid_tables = tables_in_query - self._valid_tables
             
             if invalid_tables:
-                return False, f"Unsupported Query: Table(s) '{', '.join(invalid_tables)}' do not exist in the database schema. Available tables: {', '.join(sorted(valid_tables))}"
+                return False, f"Unsupported Query: Table(s) '{', '.join(invalid_tables)}' do not exist in the database schema. Available tables: {', '.join(sorted(self._valid_tables))}"
             
             # Validate column references
             invalid_columns = []
             for table_name, col_name in columns_in_query:
-                if table_name in valid_tables:
-                    # Find the table in schema
-                    table_info = next((t for t in self.schema['tables'] if t['table_name'] == table_name), None)
-                    if table_info:
-                        valid_cols = set(table_info['columns'].keys())
-                        if col_name not in valid_cols:
-                            invalid_columns.append(f"{table_name}.{col_name}")
+                if table_name in self._valid_tables and col_name not in self._cols_by_table[table_name]:
+                    invalid_columns.append((table_name, col_name))
             
             if invalid_columns:
                 # Get available columns for the tables mentioned
                 table_columns_info = []
-                for invalid_col in invalid_columns:
-                    table_name = invalid_col.split('.')[0]
-                    table_info = next((t for t in self.schema['tables'] if t['table_name'] == table_name), None)
-                    if table_info:
-                        available_cols = list(table_info['columns'].keys())
-                        table_columns_info.append(f"{table_name} table: {', '.join(available_cols)}")
+                for table_name, _ in invalid_columns:
+                    available_cols = list(self._tables_by_name[table_name]['columns'])
+                    table_columns_info.append(f"{table_name} table: {', '.join(available_cols)}")
                 
-                return False, f"Unsupported Query: Column(s) '{', '.join(invalid_columns)}' do not exist in the schema. Available columns: {'; '.join(table_columns_info)}"
+                invalid_names = [f"{table_name}.{col_name}" for table_name, col_name in invalid_columns]
+                return False, f"Unsupported Query: Column(s) '{', '.join(invalid_names)}' do not exist in the schema. Available columns: {'; '.join(table_columns_info)}"
             
             # Check for unsafe operations
             is_safe, safety_msg = self.check_unsafe_query(sql_query)
@@ -311,25 +745,292 @@ IMPORTANT: If the query cannot be answered with the available schema (missing ta
         except Exception as e:
             return False, f"Unsupported Query: SQL validation error - {str(e)}"
     
-    def process_query(self, user_query):
+    def load_templates(self):
+        """Load learned query templates from disk"""
+        templates = []
+        try:
+            with open(_TEMPLATES_PATH, 'r', encoding='utf-8') as f:
+                for entry in json.load(f):
+                    if not all(key in entry for key in ('parts', 'slot_order', 'sql', 'slots', 'examples')):
+                        continue  # Written by an older version without example tracking
+                    entry['regex'] = self._compile_template(entry)
+                    templates.append(entry)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"DEBUG - Could not load query templates: {e}")
+        return templates
+    
+    def save_templates(self):
+        """Persist learned query templates so they are reused across sessions (caller holds _templates_lock)"""
+        entries = [{key: value for key, value in entry.items() if key != 'regex'} for entry in self._templates]
+        try:
+            _write_atomic(_TEMPLATES_PATH, json.dumps(entries, indent=2).encode('utf-8'))
+        except OSError as e:
+            print(f"DEBUG - Could not save query templates: {e}")
+    
+    def _compile_template(self, entry):
+        """Build the prompt regex for a template from the slot values seen in its examples.
+        
+        Number slots accept any number once at least two different values were seen;
+        string slots only ever accept values that appeared in a validated example.
+        """
+        pattern_parts = [re.escape(entry['parts'][0])]
+        for slot_name, fixed_text in zip(entry['slot_order'], entry['parts'][1:]):
+            seen_values = {example[slot_name] for example in entry['examples']}
+            if entry['slots'][slot_name] == 'number' and len(seen_values) > 1:
+                slot_pattern = _NUMBER_SLOT_PATTERN
+            else:
+                slot_pattern = '|'.join(re.escape(value) for value in sorted(seen_values, key=len, reverse=True))
+            pattern_parts.append(f"(?P<{slot_name}>{slot_pattern})")
+            pattern_parts.append(re.escape(fixed_text))
+        return re.compile(''.join(pattern_parts), re.IGNORECASE)
+    
+    def match_template(self, user_query):
+        """Fill a learned SQL template if the query matches one, otherwise return None"""
+        normalized_query = ' '.join(user_query.split())
+        with self._templates_lock:
+            # A template is only trusted once two different examples produced the same SQL skeleton
+            templates = [entry for entry in self._templates if len(entry['examples']) >= _TEMPLATE_MIN_EXAMPLES]
+        
+        for entry in templates:
+            match = entry['regex'].fullmatch(normalized_query)
+            if not match:
+                continue
+            
+            values = {}
+            for slot_name, kind in entry['slots'].items():
+                value = match.group(slot_name)
+                if kind == 'string':
+                    # Use the value exactly as it appeared in a validated example, quoted for SQL
+                    value = next(example[slot_name] for example in entry['examples']
+                                 if example[slot_name].lower() == value.lower())
+                    value = value.replace("'", "''")
+                values[slot_name] = value
+            
+            print(f"DEBUG - Template hit: {entry['regex'].pattern}")
+            return entry['sql'].format(**values)
+        return None
+    
+    def learn_template(self, user_query, sql_query):
+        """Record a validated query/SQL pair as an example of a reusable template.
+        
+        SQL literals that also appear verbatim in the user query become named slots,
+        e.g. "show open incidents for John Doe" -> "... WHERE u.name = '{s0}'". Pairs
+        with the same query text and SQL skeleton are clustered into one template.
+        """
+        normalized_query = ' '.join(user_query.split())
+        literals = list(_SQL_LITERAL_RE.finditer(sql_query))
+        
+        # Assign a slot to every distinct literal that occurs exactly once in the query
+        slots = {}
+        spans = []
+        for literal in literals:
+            is_number = literal.group(1) is None
+            value = literal.group(2) if is_number else literal.group(1).replace("''", "'")
+            if not value or value in slots:
+                continue
+            occurrences = list(re.finditer(r'\b' + re.escape(value) + r'\b', normalized_query))
+            if len(occurrences) != 1:
+                continue
+            slots[value] = (f"s{len(slots)}", 'number' if is_number else 'string')
+            spans.append((occurrences[0].start(), occurrences[0].end(), value))
+        
+        if not slots:
+            return
+        
+        # Split the query into fixed text around the slot occurrences
+        spans.sort()
+        parts = []
+        slot_order = []
+        position = 0
+        for start, end, value in spans:
+            if start < position:
+                return  # Overlapping slots are ambiguous
+            parts.append(normalized_query[position:start].lower())
+            slot_order.append(slots[value][0])
+            position = end
+        parts.append(normalized_query[position:].lower())
+        
+        # Build the SQL template: braces escaped for str.format, slotted literals replaced
+        sql_parts = []
+        position = 0
+        for literal in literals:
+            is_number = literal.group(1) is None
+            value = literal.group(2) if is_number else literal.group(1).replace("''", "'")
+            if value not in slots:
+                continue
+            sql_parts.append(sql_query[position:literal.start()].replace('{', '{{').replace('}', '}}'))
+            slot_name = slots[value][0]
+            sql_parts.append(f"{{{slot_name}}}" if is_number else f"'{{{slot_name}}}'")
+            position = literal.end()
+        sql_parts.append(sql_query[position:].replace('{', '{{').replace('}', '}}'))
+        sql_template = ''.join(sql_parts)
+        
+        example = {slot_name: value for value, (slot_name, _) in slots.items()}
+        with self._templates_lock:
+            entry = next((e for e in self._templates if e['parts'] == parts and e['sql'] == sql_template), None)
+            if entry is None:
+                entry = {'parts': parts, 'slot_order': slot_order, 'sql': sql_template,
+                         'slots': dict(slots.values()), 'examples': []}
+                self._templates.append(entry)
+            elif example in entry['examples']:
+                return
+            entry['examples'].append(example)
+            entry['regex'] = self._compile_template(entry)
+            self.save_templates()
+        print(f"DEBUG - Recorded template example ({len(entry['examples'])}): {entry['regex'].pattern}")
+    
+    def _submit_prompt(self, batch_queue, prompt):
+        """Queue a prompt for the next batched Gemini request and return a Future for its text"""
+        future = Future()
+        with batch_queue['lock']:
+            batch_queue['pending'].append((prompt, future))
+            # The first prompt in a window schedules the flush; later ones ride along
+            if len(batch_queue['pending']) == 1:
+                timer = threading.Timer(_BATCH_WINDOW_SECONDS, self._flush_pending, args=(batch_queue,))
+                timer.daemon = True
+                timer.start()
+        return future
+    
+    def _flush_pending(self, batch_queue):
+        """Send all prompts queued by one process_batch call to Gemini and resolve their Futures"""
+        with batch_queue['lock']:
+            batch = batch_queue['pending'][:_BATCH_MAX_SIZE]
+            batch_queue['pending'] = batch_queue['pending'][_BATCH_MAX_SIZE:]
+            if batch_queue['pending']:
+                timer = threading.Timer(0, self._flush_pending, args=(batch_queue,))
+                timer.daemon = True
+                timer.start()
+        
+        if len(batch) == 1:
+            self._resolve_prompt(*batch[0])
+            return
+        
+        try:
+            answers = self._generate_batch([prompt for prompt, _ in batch])
+        except Exception as e:
+            # Fall back to individual requests, sent concurrently rather than one after another
+            print(f"DEBUG - Batched Gemini request failed, retrying individually: {e}")
+            for prompt, future in batch:
+                _EXECUTOR.submit(self._resolve_prompt, prompt, future)
+            return
+        
+        for (_, future), answer in zip(batch, answers):
+            future.set_result(answer)
+    
+    def _resolve_prompt(self, prompt, future):
+        """Answer a single prompt with its own Gemini request"""
+        try:
+            future.set_result(self._model.generate_content(prompt).text)
+        except Exception as e:
+            future.set_exception(e)
+    
+    def _generate_batch(self, prompts):
+        """Answer several prompts with one Gemini request using numbered sections"""
+        parts = [f"You will receive {len(prompts)} independent requests. Answer each one separately, "
+                 f"following its own instructions. Start each answer with a line containing only "
+                 f"'### Answer <n>' where <n> is the request number, and output nothing else.\n"]
+        for number, prompt in enumerate(prompts, 1):
+            parts.append(f"### Request {number}\n{prompt}\n")
+        
+        response = self._model.generate_content('\n'.join(parts))
+        sections = _BATCH_ANSWER_RE.split(response.text)
+        
+        # split() yields [preamble, number, answer, number, answer, ...]
+        answers = {int(number): answer.strip() for number, answer in zip(sections[1::2], sections[2::2])}
+        if sorted(answers) != list(range(1, len(prompts) + 1)):
+            raise ValueError(f"expected {len(prompts)} numbered answers, got {sorted(answers)}")
+        return [answers[number] for number in range(1, len(prompts) + 1)]
+    
+    def process_batch(self, user_queries):
+        """Process several queries concurrently so their Gemini calls share batched requests"""
+        # Each call gets its own queue so queries from different sessions are never combined
+        batch_queue = {'pending': [], 'lock': threading.Lock()}
+        
+        def process_in_batch(user_query):
+            self._batch_local.queue = batch_queue
+            try:
+                return self.process_query(user_query)
+            finally:
+                self._batch_local.queue = None
+        
+        # A dedicated pool: process_query itself waits on work queued to _EXECUTOR
+        with ThreadPoolExecutor(max_workers=_BATCH_MAX_SIZE) as pool:
+            return list(pool.map(process_in_batch, user_queries))
+    
+    def critique_sql(self, processed_query, sql_query):
+        """Ask Gemini to double-check that the SQL is a read-only answer to the query"""
+        try:
+            prompt = f"""{self._schema_context}
+
+Natural language query:
+"{processed_query}"
+
+Proposed SQL:
+{sql_query}
+
+Does the proposed SQL correctly answer the query using only the schema above, without modifying any data?
+Respond with exactly "OK" if it does, otherwise respond with "ERROR: " followed by a one-line reason.
+"""
+            response = self._model.generate_content(prompt)
+            verdict = response.text.strip()
+            print(f"DEBUG - Critic verdict: {repr(verdict)}")
+            
+            if verdict.upper().startswith('ERROR:'):
+                return False, f"Unsupported Query: {verdict[len('ERROR:'):].strip()}"
+            return True, "Critic approved"
+        except Exception as e:
+            # The critic is advisory; never fail a query because it was unavailable
+            print(f"DEBUG - Critic check failed: {e}")
+            return True, "Critic unavailable"
+    
+    def process_query(self, user_query, on_chunk=None):
         """Main processing pipeline"""
         # Step 1: Preprocessing
         processed_data = self.preprocess_query(user_query)
         if isinstance(processed_data, tuple):
             return None, processed_data[1], None, None  # Return error from preprocessing
         
-        # Step 2: Generate SQL with Gemini
-        sql_query, error = self.generate_sql_with_gemini(processed_data)
+        # Step 2: Try learned query templates before calling Gemini
+        sql_query = self.match_template(user_query)
+        if sql_query and self.validate_sql(sql_query)[0]:
+            return sql_query, None, sql_query, "Validation Passed"
+        
+        # Step 3: Generate SQL with Gemini
+        sql_query, error = self.generate_sql_with_gemini(processed_data, on_chunk)
         if error:
             return None, f"SQL Generation Error: {error}", None, None
+        if processed_data['cache_hit']:
+            # Cached SQL was validated when it was served
+            return sql_query, None, sql_query, "Validation Passed"
+        
+        # Step 4: Validate SQL, running the optional Gemini critic concurrently
+        validation_future = _EXECUTOR.submit(self.validate_sql, sql_query)
+        critic_future = None
+        if self._critic_enabled:
+            critic_future = _EXECUTOR.submit(self.critique_sql, processed_data['query'], sql_query)
         
-        # Step 3: Validate SQL
-        is_valid, validation_msg = self.validate_sql(sql_query)
+        is_valid, validation_msg = validation_future.result()
         if not is_valid:
             return None, validation_msg, sql_query, "Validation Failed"
         
+        if critic_future is not None:
+            is_approved, critic_msg = critic_future.result()
+            if not is_approved:
+                return None, critic_msg, sql_query, "Validation Failed"
+        
+        self.cache_sql(processed_data, sql_query)
+        self.learn_template(user_query, sql_query)
         return sql_query, None, sql_query, "Validation Passed"
 
+@st.cache_resource
+def get_system():
+    """Create the Text2SQL system once per server process and share it across sessions"""
+    system = Text2SQLSystem()
+    _EXECUTOR.submit(system.warm_up)
+    return system
+
 def main():
     st.set_page_config(
         page_title="Text2SQL System",
@@ -337,16 +1038,15 @@ def main():
         layout="wide"
     )
     
+    # Shared system instance, warmed up in the background on first use
+    system = get_system()
+    
     st.title("🔍 Text2SQL System")
     st.markdown("Convert natural language queries to SQL using AI")
     
-    # Initialize the system
-    if 'text2sql_system' not in st.session_state:
-        st.session_state.text2sql_system = Text2SQLSystem()
-    
-    system = st.session_state.text2sql_system
-    
     if not system.schema:
+        # Don't keep sharing a broken instance; retry loading on the next run
+        get_system.clear()
         st.error("Failed to load database schema. Please check the schema file.")
         return
     
@@ -354,12 +1054,9 @@ def main():
     with st.sidebar:
         st.header("📊 Database Schema")
         
-        for table in system.schema['tables']:
-            with st.expander(f"Table: {table['table_name']}"):
-                st.write(f"**Description:** {table['description']}")
-                st.write("**Columns:**")
-                for col_name, col_desc in table['columns'].items():
-                    st.write(f"• {col_name}: {col_desc}")
+        for table_name, table_markdown in system.sidebar_markdown:
+            with st.expander(f"Table: {table_name}"):
+                st.markdown(table_markdown)
     
     # Main interface
     col1, col2 = st.columns([2, 1])
@@ -371,13 +1068,31 @@ def main():
             placeholder="Example: Show all open incidents reported by John Doe",
             height=100
         )
+        batch_mode = st.checkbox("Batch mode (one query per line)")
         
         if st.button("🔄 Generate SQL", type="primary"):
             if not user_query.strip():
                 st.warning("Please enter a query first!")
+            elif batch_mode:
+                user_queries = [line.strip() for line in user_query.splitlines() if line.strip()]
+                with st.spinner(f"Processing {len(user_queries)} queries..."):
+                    results = system.process_batch(user_queries)
+                
+                for query_text, (sql_query, error, gemini_response, validation_status) in zip(user_queries, results):
+                    st.markdown(f"**{query_text}**")
+                    if error:
+                        st.error(f"🚫 {error}" if "Unsupported Query" in error else f"❌ {error}")
+                    else:
+                        st.code(sql_query, language="sql")
             else:
                 with st.spinner("Processing your query..."):
-                    sql_query, error, gemini_response, validation_status = system.process_query(user_query)
+                    # Show the SQL progressively while Gemini streams it
+                    stream_placeholder = st.empty()
+                    sql_query, error, gemini_response, validation_status = system.process_query(
+                        user_query,
+                        on_chunk=lambda partial_sql: stream_placeholder.code(partial_sql, language="sql")
+                    )
+                    stream_placeholder.empty()
                     
                     if error:
                         if "Unsupported Query" in error: